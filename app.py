@@ -1,26 +1,130 @@
 import os
+import io
 import math
-from datetime import datetime, date
+import queue
+import secrets
+import atexit
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+from datetime import datetime, date, timezone
 
 from flask import (
-    Flask, render_template, request, redirect,
+    Flask, Request, render_template, request, redirect,
     url_for, flash, jsonify, session, g
 )
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.security import check_password_hash
 from functools import wraps
+from jinja2 import FileSystemBytecodeCache
+import bcrypt
+import numpy as np
+import orjson
+
+try:  # optional: JIT the scalar haversine when numba is installed
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Base directory for DB and file storage
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+PHOTOS_DIR = os.path.join(BASE_DIR, "photos")
+os.makedirs(PHOTOS_DIR, exist_ok=True)
+
+
+def _json_default(obj):
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson (used by jsonify, get_json and |tojson).
+
+    Datetimes are encoded natively as ISO 8601; naive ones are the app's
+    UTC timestamps and get a +00:00 offset.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# Largest accepted attendance photo
+MAX_PHOTO_BYTES = 8 * 1024 * 1024
+
+
+class InMemoryUploadRequest(Request):
+    """Parse uploaded files into memory instead of a spooled temp file.
+
+    Photos are read into memory for the photo writer anyway, and
+    MAX_CONTENT_LENGTH bounds the whole body, so spilling them to a temp
+    file first would only be an extra disk round-trip.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return io.BytesIO()
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.request_class = InMemoryUploadRequest
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "temp-secret-key")
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(BASE_DIR, "geofence_attendance.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Rejected with 413 before parsing; slack for the lat/lng/action fields
+app.config["MAX_CONTENT_LENGTH"] = MAX_PHOTO_BYTES + 64 * 1024
+# Compiled templates are kept in the system temp dir across restarts
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Fixed bcrypt cost (~250 ms per hash on a typical server core)
+_BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "11"))
+# Checked against when the email is unknown, so that a failed login
+# costs the same whether or not the account exists
+_DUMMY_HASH = bcrypt.hashpw(b"x" * 12, bcrypt.gensalt(_BCRYPT_ROUNDS))
+# Hashes made at the current cost start with this; others get upgraded
+_BCRYPT_PREFIX = _DUMMY_HASH.decode()[:7]
+
+# Longer passwords are rejected before they reach the hash
+MAX_PASSWORD_BYTES = 1024
+
+# NORMAL or FULL; see set_sqlite_pragmas
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+if SQLITE_SYNCHRONOUS not in ("NORMAL", "FULL"):
+    raise ValueError("SQLITE_SYNCHRONOUS must be NORMAL or FULL")
 
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets location pings be written without blocking readers.
+
+    synchronous=NORMAL skips the fsync on each commit: a crash can't corrupt
+    the database, but a power loss may drop the last few commits. Set
+    SQLITE_SYNCHRONOUS=FULL if attendance records must survive that too.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute("PRAGMA cache_size=-65536")      # 64 MiB page cache
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")    # read through a 256 MiB map
+    cursor.close()
+
+
 # ---------------------------------------------------------
 #                     DATABASE MODELS
 # ---------------------------------------------------------
@@ -36,12 +140,22 @@ class User(db.Model):
     attendances = db.relationship("Attendance", backref="user", lazy=True)
     location_logs = db.relationship("LocationPing", backref="user", lazy=True)
 
-    # Password utilities
+    # Password utilities (bcrypt only looks at the first 72 bytes)
     def set_password(self, pwd):
-        self.password_hash = generate_password_hash(pwd)
+        salt = bcrypt.gensalt(_BCRYPT_ROUNDS)
+        self.password_hash = bcrypt.hashpw(pwd.encode()[:72], salt).decode()
 
     def verify_password(self, pwd):
-        return check_password_hash(self.password_hash, pwd)
+        if not self.password_hash:
+            return False
+        if not self.password_hash.startswith("$2"):
+            # Accounts created before the switch still hold werkzeug hashes
+            return check_password_hash(self.password_hash, pwd)
+        return bcrypt.checkpw(pwd.encode()[:72], self.password_hash.encode())
+
+    def password_needs_rehash(self):
+        """True for werkzeug hashes and bcrypt hashes at another cost."""
+        return not self.password_hash.startswith(_BCRYPT_PREFIX)
 
 
 class GeoFence(db.Model):
@@ -54,6 +168,9 @@ class GeoFence(db.Model):
 
 
 class Attendance(db.Model):
+    # One row per user per day; also serves the per-day lookups
+    __table_args__ = (db.Index("ix_att_user_date", "user_id", "date", unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
@@ -73,12 +190,37 @@ class Attendance(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class Microdegrees(db.TypeDecorator):
+    """Degrees stored as an integer count of 1e-6 degrees (about 11 cm).
+
+    SQLite stores these in 4 bytes instead of an 8-byte REAL, and the
+    step is far finer than phone GPS (~1 m). Only values that passed
+    `valid_coordinates` may be bound; anything else raises ValueError.
+    """
+
+    impl = db.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        # round() raises on inf/NaN and huge values overflow SQLite INTEGER
+        if not (math.isfinite(value) and -180.0 <= value <= 180.0):
+            raise ValueError(f"{value!r} is not a coordinate in degrees")
+        return round(value * 1_000_000)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else value / 1_000_000
+
+
 class LocationPing(db.Model):
+    __table_args__ = (db.Index("ix_ping_user_ts", "user_id", "timestamp"),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    lat = db.Column(db.Float, nullable=False)
-    lng = db.Column(db.Float, nullable=False)
+    lat = db.Column(Microdegrees, nullable=False)
+    lng = db.Column(Microdegrees, nullable=False)
     inside_geofence = db.Column(db.Boolean, default=False)
 
 
@@ -97,11 +239,11 @@ def ensure_default_geofence():
         )
         db.session.add(gf)
         db.session.commit()
+        invalidate_fence_cache()
 
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calculate the distance between two points (in meters)."""
-    R = 6371000  # Earth radius (meters)
+def _hav(lat1, lon1, lat2, lon2):
+    R = 6371000.0  # Earth radius (meters)
     φ1, φ2 = math.radians(lat1), math.radians(lat2)
     dφ = math.radians(lat2 - lat1)
     dλ = math.radians(lon2 - lon1)
@@ -112,8 +254,332 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return R * c
 
 
+if njit is not None:
+    # An explicit signature compiles at import time, not on the first call
+    _hav = njit("f8(f8, f8, f8, f8)", cache=True, fastmath=True)(_hav)
+
+
+def valid_coordinates(lat, lng):
+    """True for finite degrees within -90..90 (lat) and -180..180 (lng)."""
+    return (math.isfinite(lat) and math.isfinite(lng)
+            and -90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0)
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Calculate the distance between two points (in meters)."""
+    return _hav(lat1, lon1, lat2, lon2)
+
+
+def haversine_vec(lat, lng, clat, clng):
+    """Vectorised `haversine_distance` from arrays of points to one center."""
+    R = 6371000
+    φ1, φ2 = np.radians(lat), math.radians(clat)
+    dφ = φ2 - φ1
+    dλ = np.radians(clng - lng)
+
+    a = np.sin(dφ/2)**2 + np.cos(φ1)*math.cos(φ2)*np.sin(dλ/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    return R * c
+
+
+# Detached, read-only copy of the active GeoFence row, plus the center
+# terms that every distance check against it would otherwise recompute
+FenceSnapshot = namedtuple(
+    "FenceSnapshot",
+    "id name center_lat center_lng radius_m cos_clat radius_rad2 distance_fn",
+)
+
+
+def make_distance_fn(center_lat, center_lng):
+    """Haversine distance (in meters) to a fixed center, as `fn(lat, lng)`.
+
+    The center's radians and cosine are bound into the closure, so each
+    call only converts and takes the cosine of the moving point.
+    """
+    R = 6371000.0
+    φ2 = math.radians(center_lat)
+    cos_φ2 = math.cos(φ2)
+    radians, sin, cos, atan2, sqrt = math.radians, math.sin, math.cos, math.atan2, math.sqrt
+
+    def distance_to_center(lat, lng):
+        φ1 = radians(lat)
+        dλ = radians(center_lng - lng)
+        a = sin((φ2 - φ1) / 2)**2 + cos(φ1)*cos_φ2*sin(dλ/2)**2
+        return 2 * R * atan2(sqrt(a), sqrt(1-a))
+
+    return distance_to_center
+
+
+def make_fence_snapshot(gf):
+    return FenceSnapshot(
+        gf.id, gf.name, gf.center_lat, gf.center_lng, gf.radius_m,
+        cos_clat=math.cos(math.radians(gf.center_lat)),
+        radius_rad2=(gf.radius_m / 6371000.0) ** 2,  # radius as a squared angle
+        distance_fn=make_distance_fn(gf.center_lat, gf.center_lng),
+    )
+
+
+def _inside_geofence(lat, lng, gf):
+    """Equirectangular inside-geofence test, returns (inside, squared radians).
+
+    At geofence scale (a few hundred meters) the flat projection is within
+    a few centimeters of the Haversine distance, and it needs no trig
+    beyond the cached cos(center_lat).
+    """
+    dy = math.radians(lat - gf.center_lat)
+    # Wrap into [-180, 180) so fences next to the antimeridian work
+    dlng = (lng - gf.center_lng + 180.0) % 360.0 - 180.0
+    dx = math.radians(dlng) * gf.cos_clat
+    d2 = dx*dx + dy*dy
+    return d2 <= gf.radius_rad2, d2
+
+
+# The fence only changes from the admin screen, so keep it in memory
+# `entry` is (snapshot, loaded_at) so both are swapped in one assignment.
+# Writes in this process drop it at once; other worker processes pick the
+# change up once GEOFENCE_CACHE_TTL seconds have passed. `stamp` counts
+# invalidations, so a reload that raced a write is not cached.
+GEOFENCE_CACHE_TTL = float(os.environ.get("GEOFENCE_CACHE_TTL", "30"))
+
+_ACTIVE_FENCE_CACHE = {"entry": None, "stamp": 0}
+_fence_cache_lock = threading.Lock()
+
+
+def invalidate_fence_cache():
+    with _fence_cache_lock:
+        _ACTIVE_FENCE_CACHE["entry"] = None
+        _ACTIVE_FENCE_CACHE["stamp"] += 1
+
+
+def record_check_in(user_id, day, now, lat, lng, photo=None):
+    """Insert or fill in today's check-in with a single UPSERT.
+
+    Returns the attendance row id, or None when the user has already
+    checked in for `day`.
+    """
+    values = {
+        "user_id": user_id,
+        "date": day,
+        "check_in_time": now,
+        "check_in_lat": lat,
+        "check_in_lng": lng,
+        "status": "Present",
+    }
+    if photo:
+        values["check_in_photo"] = photo
+
+    stmt = sqlite_insert(Attendance).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "date"],
+        set_={k: stmt.excluded[k] for k in values if k not in ("user_id", "date")},
+        where=Attendance.check_in_time.is_(None),
+    ).returning(Attendance.id)
+    row_id = db.session.execute(stmt).scalar_one_or_none()
+    db.session.commit()
+    return row_id
+
+
+def record_check_out(user_id, day, now, lat, lng, photo=None):
+    """Fill in today's check-out with a single UPDATE.
+
+    Returns False when there is no open check-in for `day` (never checked
+    in, or already checked out).
+    """
+    values = {
+        "check_out_time": now,
+        "check_out_lat": lat,
+        "check_out_lng": lng,
+    }
+    if photo:
+        values["check_out_photo"] = photo
+
+    stmt = (
+        update(Attendance)
+        .where(
+            Attendance.user_id == user_id,
+            Attendance.date == day,
+            Attendance.check_in_time.isnot(None),
+            Attendance.check_out_time.is_(None),
+        )
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.session.execute(stmt)
+    db.session.commit()
+    return result.rowcount > 0
+
+
 def get_active_fence():
-    return GeoFence.query.filter_by(active=True).first()
+    """Return the active geofence as a `FenceSnapshot` (or None)."""
+    entry = _ACTIVE_FENCE_CACHE["entry"]
+    now = time.monotonic()
+    if entry is None or now - entry[1] > GEOFENCE_CACHE_TTL:
+        stamp = _ACTIVE_FENCE_CACHE["stamp"]
+        gf = GeoFence.query.filter_by(active=True).first()
+        entry = (make_fence_snapshot(gf) if gf else None, now)
+        # An invalidation since the query means this row may already be old
+        with _fence_cache_lock:
+            if _ACTIVE_FENCE_CACHE["stamp"] == stamp:
+                _ACTIVE_FENCE_CACHE["entry"] = entry
+    return entry[0]
+
+
+# ---------------------- PING WRITER ---------------------- #
+
+# Location pings are written in batches by a background thread so that
+# /api/ping_location does not pay for a commit (fsync) per request.
+# A longer flush interval batches more but delays pings on the movement map.
+PING_BATCH_SIZE = int(os.environ.get("PING_BATCH_SIZE", "500"))
+PING_FLUSH_SECONDS = float(os.environ.get("PING_FLUSH_SECONDS", "0.5"))
+# Zero would leave the writer spinning without ever reading the queue
+if PING_BATCH_SIZE < 1:
+    raise ValueError("PING_BATCH_SIZE must be at least 1")
+if not (0 < PING_FLUSH_SECONDS < math.inf):
+    raise ValueError("PING_FLUSH_SECONDS must be a positive number of seconds")
+
+_ping_queue = queue.Queue()
+_ping_writer_stop = threading.Event()
+_ping_writer_lock = threading.Lock()
+_ping_writer = None
+
+
+def _ping_writer_loop():
+    # Plain Core inserts on a connection: no ORM session or unit of work
+    with app.app_context():
+        engine = db.engine
+    insert_ping = LocationPing.__table__.insert()
+
+    while not (_ping_writer_stop.is_set() and _ping_queue.empty()):
+        batch = []
+        deadline = time.monotonic() + PING_FLUSH_SECONDS
+        while len(batch) < PING_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_ping_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        if not batch:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert_ping, batch)
+        except Exception:
+            # One bad row fails the whole executemany; retry row by row so
+            # only the rows that fail on their own are lost
+            for row in batch:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(insert_ping, row)
+                except Exception:
+                    app.logger.exception("Dropped location ping of user %s", row["user_id"])
+                    forget_ping(row)
+
+
+# Last stored ping per user, used to drop repeats from stationary clients
+PING_DEDUP_METERS = 15.0
+PING_DEDUP_SECONDS = 30
+
+_last_ping = {}
+_last_ping_lock = threading.Lock()
+
+
+def should_store_ping(user_id, lat, lng, inside, now):
+    """False when the ping repeats the user's last stored one.
+
+    A repeat is within PING_DEDUP_METERS and PING_DEDUP_SECONDS of the last
+    stored ping, on the same side of the fence. Only stored pings refresh
+    the reference point, so a stationary user is still logged every
+    PING_DEDUP_SECONDS.
+    """
+    with _last_ping_lock:
+        last = _last_ping.get(user_id)
+        if last is not None:
+            last_lat, last_lng, last_inside, last_ts = last
+            if (last_inside == inside
+                    and (now - last_ts).total_seconds() <= PING_DEDUP_SECONDS
+                    and haversine_distance(lat, lng, last_lat, last_lng) <= PING_DEDUP_METERS):
+                return False
+        _last_ping[user_id] = (lat, lng, inside, now)
+        return True
+
+
+def forget_ping(row):
+    """Stop deduplicating against `row` once it failed to be stored."""
+    with _last_ping_lock:
+        point = (row["lat"], row["lng"], row["inside_geofence"], row["timestamp"])
+        if _last_ping.get(row["user_id"]) == point:
+            del _last_ping[row["user_id"]]
+
+
+def stop_ping_writer():
+    """Flush queued pings and stop the writer thread."""
+    _ping_writer_stop.set()
+    if _ping_writer is not None:
+        _ping_writer.join(timeout=5)
+
+
+def queue_ping(row):
+    global _ping_writer
+    if _ping_writer is None:
+        with _ping_writer_lock:
+            if _ping_writer is None:
+                _ping_writer = threading.Thread(
+                    target=_ping_writer_loop, name="ping-writer", daemon=True
+                )
+                _ping_writer.start()
+                atexit.register(stop_ping_writer)
+    _ping_queue.put(row)
+
+
+# ---------------------- PHOTO WRITER ---------------------- #
+
+# Attendance photos are written to disk by a background thread, so the
+# request only waits for the DB commit. With MAX_PHOTO_BYTES this bounds
+# the memory held by queued photos (MAX_PHOTO_BYTES * PHOTO_QUEUE_SIZE).
+PHOTO_QUEUE_SIZE = 32
+
+_photo_queue = queue.Queue(maxsize=PHOTO_QUEUE_SIZE)
+_photo_writer_lock = threading.Lock()
+_photo_writer = None
+
+
+def _photo_writer_loop():
+    while True:
+        item = _photo_queue.get()
+        if item is None:
+            break
+        path, blob = item
+        tmp_path = path + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)  # never leave a half-written photo
+        except OSError:
+            app.logger.exception("Could not save photo %s", path)
+
+
+def stop_photo_writer():
+    """Write queued photos and stop the writer thread."""
+    if _photo_writer is not None:
+        _photo_queue.put(None)
+        _photo_writer.join(timeout=10)
+
+
+def queue_photo(path, blob):
+    global _photo_writer
+    if _photo_writer is None:
+        with _photo_writer_lock:
+            if _photo_writer is None:
+                _photo_writer = threading.Thread(
+                    target=_photo_writer_loop, name="photo-writer", daemon=True
+                )
+                _photo_writer.start()
+                atexit.register(stop_photo_writer)
+    _photo_queue.put((path, blob))  # blocks (backpressure) when full
 
 
 # ---------------------- LOGIN DECORATORS ---------------------- #
@@ -130,19 +596,37 @@ def login_required(fn):
 def admin_required(fn):
     @wraps(fn)
     def decorated(*args, **kwargs):
-        uid = session.get("user_id")
-        user = User.query.get(uid)
-        if not uid or not user or user.role != "admin":
+        # Role comes from the signed session (see `inject_user`)
+        if not g.user or g.user.role != "admin":
             flash("Admin access only.", "danger")
             return redirect(url_for("employee_dashboard"))
         return fn(*args, **kwargs)
     return decorated
 
 
+def user_session_cache(user):
+    return {"id": user.id, "role": user.role, "name": user.name}
+
+
 @app.before_request
 def inject_user():
-    """Load current user into `g` for templates."""
-    g.user = User.query.get(session.get("user_id")) if "user_id" in session else None
+    """Load current user (and the request's clock) into `g` for templates.
+
+    Uses the id/role/name copy stored in the session at login, so most
+    requests never touch the user table. Sessions from before that cache
+    existed fall back to one lookup.
+    """
+    # Handlers use these instead of reading the clock themselves.
+    # `today` stays the server's local date, as before.
+    g.now = datetime.utcnow()
+    g.today = date.today()
+
+    cached = session.get("user_cache")
+    if cached is None and "user_id" in session:
+        user = User.query.get(session["user_id"])
+        if user:
+            cached = session["user_cache"] = user_session_cache(user)
+    g.user = SimpleNamespace(**cached) if cached else None
 
 
 # ---------------------------------------------------------
@@ -167,12 +651,18 @@ def register():
             flash("Every field is mandatory.", "danger")
             return redirect(url_for("register"))
 
+        if len(password.encode()) > MAX_PASSWORD_BYTES:
+            flash("Password is too long.", "danger")
+            return redirect(url_for("register"))
+
+        # Cheap checks first; hashing is the expensive step
         if User.query.filter_by(email=email).first():
             flash("Email already exists.", "danger")
             return redirect(url_for("register"))
 
         # First user becomes admin automatically
-        role = "admin" if User.query.count() == 0 else "employee"
+        is_first = db.session.query(User.id).limit(1).first() is None
+        role = "admin" if is_first else "employee"
 
         user = User(name=name, email=email, role=role)
         user.set_password(password)
@@ -192,13 +682,28 @@ def login():
         email = request.form.get("email", "").lower()
         pwd = request.form.get("password", "")
 
+        if len(pwd.encode()) > MAX_PASSWORD_BYTES:
+            flash("Incorrect login details.", "danger")
+            return redirect(url_for("login"))
+
         user = User.query.filter_by(email=email).first()
+        if user:
+            valid = user.verify_password(pwd)
+        else:
+            bcrypt.checkpw(pwd.encode()[:72], _DUMMY_HASH)
+            valid = False
 
-        if not user or not user.verify_password(pwd):
+        if not valid:
             flash("Incorrect login details.", "danger")
             return redirect(url_for("login"))
 
+        # Only possible now, while the plain password is at hand
+        if user.password_needs_rehash():
+            user.set_password(pwd)
+            db.session.commit()
+
         session["user_id"] = user.id
+        session["user_cache"] = user_session_cache(user)
         return redirect(url_for("admin_dashboard" if user.role == "admin" else "employee_dashboard"))
 
     return render_template("login.html")
@@ -206,7 +711,7 @@ def login():
 
 @app.route("/logout")
 def logout():
-    session.clear()
+    session.clear()  # also drops the cached user
     flash("Logged out successfully.", "info")
     return redirect(url_for("login"))
 
@@ -219,16 +724,19 @@ def logout():
 @login_required
 def employee_dashboard():
     gf = get_active_fence()
-    today = date.today()
-
-    todays_record = Attendance.query.filter_by(
-        user_id=g.user.id, date=today
-    ).first()
+    today = g.today
 
-    recent = Attendance.query.filter_by(
+    # Newest rows first, so today's record (if any) is rows[0]
+    rows = Attendance.query.options(load_only(
+        Attendance.date, Attendance.check_in_time,
+        Attendance.check_out_time, Attendance.status,
+    )).filter_by(
         user_id=g.user.id
     ).order_by(Attendance.date.desc()).limit(10).all()
 
+    todays_record = rows[0] if rows and rows[0].date == today else None
+    recent = rows
+
     return render_template(
         "employee_dashboard.html",
         geofence=gf,
@@ -249,21 +757,23 @@ def mark_attendance():
     if None in (lat, lng) or action not in {"check_in", "check_out"}:
         return jsonify({"success": False, "message": "Invalid data"}), 400
 
-    try:
-        lat = float(lat)
-        lng = float(lng)
-    except:
-        return jsonify({"success": False, "message": "Invalid coordinates"}), 400
+    # JSON numbers arrive as int/float already; only strings need parsing
+    if not (isinstance(lat, (int, float)) and isinstance(lng, (int, float))):
+        try:
+            lat = float(lat)
+            lng = float(lng)
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "message": "Invalid coordinates"}), 400
 
     gf = get_active_fence()
     if not gf:
         return jsonify({"success": False, "message": "No geofence configured"}), 500
 
-    # Distance evaluation
-    distance = haversine_distance(lat, lng, gf.center_lat, gf.center_lng)
-    inside = distance <= gf.radius_m
+    # Distance evaluation (exact meters only needed for the rejection message)
+    inside, _ = _inside_geofence(lat, lng, gf)
 
     if not inside:
+        distance = gf.distance_fn(lat, lng)
         return jsonify({
             "success": False,
             "inside": False,
@@ -272,39 +782,24 @@ def mark_attendance():
         })
 
     # Attendance Logic
-    today = date.today()
-    record = Attendance.query.filter_by(user_id=g.user.id, date=today).first()
-    now = datetime.utcnow()
+    today = g.today
+    now = g.now
 
     if action == "check_in":
-        if record and record.check_in_time:
+        if not record_check_in(g.user.id, today, now, lat, lng):
             return jsonify({"success": False, "message": "Already checked in"})
 
-        if not record:
-            record = Attendance(user_id=g.user.id, date=today)
-            db.session.add(record)
-
-        record.check_in_time = now
-        record.check_in_lat = lat
-        record.check_in_lng = lng
-        record.status = "Present"
-        db.session.commit()
-
-        return jsonify({"success": True, "message": "Check-in recorded", "timestamp": now.isoformat()})
+        return jsonify({"success": True, "message": "Check-in recorded", "timestamp": now})
 
     if action == "check_out":
+        if record_check_out(g.user.id, today, now, lat, lng):
+            return jsonify({"success": True, "message": "Check-out recorded", "timestamp": now})
+
+        record = Attendance.query.filter_by(user_id=g.user.id, date=today).first()
         if not record or not record.check_in_time:
             return jsonify({"success": False, "message": "No check-in found"})
 
-        if record.check_out_time:
-            return jsonify({"success": False, "message": "Already checked out"})
-
-        record.check_out_time = now
-        record.check_out_lat = lat
-        record.check_out_lng = lng
-        db.session.commit()
-
-        return jsonify({"success": True, "message": "Check-out recorded", "timestamp": now.isoformat()})
+        return jsonify({"success": False, "message": "Already checked out"})
 
 
 @app.route("/api/ping_location", methods=["POST"])
@@ -317,29 +812,42 @@ def ping_location():
     if lat is None or lng is None:
         return jsonify({"success": False, "message": "Invalid coordinates"}), 400
 
-    try:
-        lat = float(lat)
-        lng = float(lng)
-    except:
+    # JSON numbers arrive as int/float already; only strings need parsing
+    if not (isinstance(lat, (int, float)) and isinstance(lng, (int, float))):
+        try:
+            lat = float(lat)
+            lng = float(lng)
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "message": "Invalid coordinates"}), 400
+    # float() accepts "nan"/"inf"; such rows would fail in the ping writer
+    if not valid_coordinates(lat, lng):
         return jsonify({"success": False, "message": "Invalid coordinates"}), 400
 
     gf = get_active_fence()
     if not gf:
         return jsonify({"success": False, "message": "No geofence"}), 500
 
-    distance = haversine_distance(lat, lng, gf.center_lat, gf.center_lng)
-    inside = distance <= gf.radius_m
+    inside, _ = _inside_geofence(lat, lng, gf)
 
-    log = LocationPing(user_id=g.user.id, lat=lat, lng=lng, inside_geofence=inside)
-    db.session.add(log)
-    db.session.commit()
+    now = g.now
+    if should_store_ping(g.user.id, lat, lng, inside, now):
+        queue_ping({
+            "user_id": g.user.id,
+            "lat": lat,
+            "lng": lng,
+            "inside_geofence": inside,
+            "timestamp": now,
+        })
 
-    return jsonify({
+    payload = {
         "success": True,
         "inside": inside,
-        "distance_m": distance,
-        "timestamp": log.timestamp.isoformat()
-    })
+        "timestamp": now
+    }
+    # The exact distance is only reported (and computed) when outside
+    if not inside:
+        payload["distance_m"] = gf.distance_fn(lat, lng)
+    return jsonify(payload)
 
 
 @app.route("/api/geofence")
@@ -365,10 +873,22 @@ def geofence_info():
 @admin_required
 def admin_dashboard():
     gf = get_active_fence()
-    users = User.query.order_by(User.created_at.desc()).all()
-    logs = Attendance.query.order_by(
+    # Only the columns the tables show (never the password hashes)
+    users = User.query.options(load_only(
+        User.name, User.email, User.role, User.created_at,
+    )).order_by(User.created_at.desc()).all()
+    logs = Attendance.query.options(
+        load_only(
+            Attendance.date, Attendance.check_in_time,
+            Attendance.check_out_time, Attendance.status,
+        ),
+        joinedload(Attendance.user).load_only(User.name),
+    ).order_by(
         Attendance.date.desc(), Attendance.created_at.desc()
     ).limit(20).all()
+    # Two round-trips are cheap on SQLite (same process, no network). If the
+    # app moves to Postgres, fold both lists into one UNION ALL query with a
+    # marker column and split the rows here, so the page costs one round-trip.
 
     return render_template(
         "admin_dashboard.html", geofence=gf, users=users, latest_attendance=logs
@@ -388,62 +908,52 @@ def mark_attendance_photo():
 
     try:
         lat, lng = float(lat), float(lng)
-    except:
+    except (TypeError, ValueError):
         return jsonify({"success": False, "message": "Invalid coordinates"}), 400
 
     gf = get_active_fence()
     if not gf:
         return jsonify({"success": False, "message": "Geofence missing"}), 500
 
-    distance = haversine_distance(lat, lng, gf.center_lat, gf.center_lng)
-    inside = distance <= gf.radius_m
+    inside, _ = _inside_geofence(lat, lng, gf)
 
     if not inside:
         return jsonify({"success": False, "message": "Outside geofence"}), 400
 
-    today = date.today()
-    record = Attendance.query.filter_by(user_id=g.user.id, date=today).first()
-    now = datetime.utcnow()
+    today = g.today
+    now = g.now
 
-    photos_dir = os.path.join(BASE_DIR, "photos")
-    os.makedirs(photos_dir, exist_ok=True)
+    # The parsed upload is a BytesIO (see InMemoryUploadRequest); getvalue()
+    # hands over its buffer, where read() would copy it
+    blob = request.files["photo"].stream.getvalue()
+    # Bodies over MAX_CONTENT_LENGTH never get here; this only catches a
+    # photo that fits in the 64 KiB slack left for the other fields
+    if len(blob) > MAX_PHOTO_BYTES:
+        return jsonify({"success": False, "message": "Photo too large"}), 413
 
-    photo = request.files["photo"]
-    filename = f"{g.user.id}_{action}_{now.strftime('%Y%m%d%H%M%S')}.jpg"
-    save_path = os.path.join(photos_dir, filename)
-    photo.save(save_path)
+    # Random suffix keeps same-second uploads apart, across restarts too
+    epoch = int(now.replace(tzinfo=timezone.utc).timestamp())  # `now` is naive UTC
+    filename = f"{g.user.id}_{action}_{epoch}_{secrets.token_hex(4)}.jpg"
+    save_path = os.path.join(PHOTOS_DIR, filename)
 
+    # The photo is only queued for writing once its row is committed
     if action == "check_in":
-        if record and record.check_in_time:
+        if not record_check_in(g.user.id, today, now, lat, lng, photo=filename):
             return jsonify({"success": False, "message": "Already checked in"})
 
-        if not record:
-            record = Attendance(user_id=g.user.id, date=today)
-            db.session.add(record)
-
-        record.check_in_time = now
-        record.check_in_lat = lat
-        record.check_in_lng = lng
-        record.check_in_photo = filename
-        record.status = "Present"
-        db.session.commit()
-
+        queue_photo(save_path, blob)
         return jsonify({"success": True, "message": "Check-in with photo saved"})
 
     if action == "check_out":
+        if record_check_out(g.user.id, today, now, lat, lng, photo=filename):
+            queue_photo(save_path, blob)
+            return jsonify({"success": True, "message": "Check-out with photo saved"})
+
+        record = Attendance.query.filter_by(user_id=g.user.id, date=today).first()
         if not record or not record.check_in_time:
             return jsonify({"success": False, "message": "Not checked in yet"})
 
-        if record.check_out_time:
-            return jsonify({"success": False, "message": "Already checked out"})
-
-        record.check_out_time = now
-        record.check_out_lat = lat
-        record.check_out_lng = lng
-        record.check_out_photo = filename
-        db.session.commit()
-
-        return jsonify({"success": True, "message": "Check-out with photo saved"})
+        return jsonify({"success": False, "message": "Already checked out"})
 
     return jsonify({"success": False, "message": "Invalid action"})
 
@@ -451,7 +961,8 @@ def mark_attendance_photo():
 @app.route("/admin/geofence", methods=["GET", "POST"])
 @admin_required
 def admin_geofence():
-    gf = get_active_fence()
+    # Needs the ORM row (not the cached snapshot) since it may be updated
+    gf = GeoFence.query.filter_by(active=True).first()
 
     if request.method == "POST":
         name = request.form.get("name", "").strip() or "Office Zone"
@@ -463,7 +974,7 @@ def admin_geofence():
             lat = float(lat)
             lng = float(lng)
             radius = float(radius)
-        except:
+        except (TypeError, ValueError):
             flash("Incorrect geofence values.", "danger")
             return redirect(url_for("admin_geofence"))
 
@@ -477,6 +988,7 @@ def admin_geofence():
             db.session.add(gf)
 
         db.session.commit()
+        invalidate_fence_cache()
         flash("Geofence saved successfully.", "success")
         return redirect(url_for("admin_geofence"))
 
@@ -490,24 +1002,39 @@ def user_movement(user_id):
 
     date_str = request.args.get("date")
     try:
-        chosen_date = datetime.strptime(date_str, "%Y-%m-%d").date() if date_str else date.today()
-    except:
-        chosen_date = date.today()
+        chosen_date = datetime.strptime(date_str, "%Y-%m-%d").date() if date_str else g.today
+    except ValueError:
+        chosen_date = g.today
 
     start = datetime.combine(chosen_date, datetime.min.time())
     end = datetime.combine(chosen_date, datetime.max.time())
 
-    pings = LocationPing.query.filter(
-        LocationPing.user_id == user.id,
-        LocationPing.timestamp >= start,
-        LocationPing.timestamp <= end
-    ).order_by(LocationPing.timestamp).all()
+    rows = db.session.execute(
+        select(
+            LocationPing.lat, LocationPing.lng,
+            LocationPing.timestamp, LocationPing.inside_geofence,
+        ).where(
+            LocationPing.user_id == user.id,
+            LocationPing.timestamp >= start,
+            LocationPing.timestamp <= end
+        ).order_by(LocationPing.timestamp)
+    ).all()
+
+    # Distance of every ping to the fence center in one vectorised pass.
+    # zip(*rows) transposes to columns in C, much faster than pulling each
+    # attribute in a generator.
+    gf = get_active_fence()
+    if gf and rows:
+        lat, lng = (np.array(col, dtype=np.float64) for col in tuple(zip(*rows))[:2])
+        distances = haversine_vec(lat, lng, gf.center_lat, gf.center_lng).tolist()
+    else:
+        distances = [None] * len(rows)
 
     return render_template(
         "user_movement.html",
         user=user,
-        pings=pings,
-        geofence=get_active_fence(),
+        pings=list(zip(rows, distances)),
+        geofence=gf,
         target_date=chosen_date,
     )
 
@@ -516,16 +1043,61 @@ def user_movement(user_id):
 #                    CLI / INITIALIZATION
 # ---------------------------------------------------------
 
+def _migrate_ping_coordinates():
+    """Rewrite a location_ping table that still stores lat/lng as FLOAT."""
+    columns = {c["name"]: c["type"] for c in inspect(db.engine).get_columns("location_ping")}
+    if isinstance(columns["lat"], db.Integer):
+        return
+    # SQLite cannot change a column's type in place, so copy into a new table
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE location_ping RENAME TO location_ping_old")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_ping_user_ts")
+        LocationPing.__table__.create(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO location_ping (id, user_id, timestamp, lat, lng, inside_geofence) "
+            "SELECT id, user_id, timestamp, "
+            "CAST(round(lat * 1000000) AS INTEGER), CAST(round(lng * 1000000) AS INTEGER), "
+            "inside_geofence FROM location_ping_old"
+        )
+        conn.exec_driver_sql("DROP TABLE location_ping_old")
+
+
+def create_schema():
+    db.create_all()
+    _migrate_ping_coordinates()
+    # create_all() skips tables that already exist, indexes included
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+# base.html is listed too: {% extends %} is only resolved at render time
+TEMPLATES = (
+    "base.html", "login.html", "register.html", "employee_dashboard.html",
+    "admin_dashboard.html", "admin_geofence.html", "user_movement.html",
+)
+
+
+def warm_templates():
+    """Compile every template now rather than on a worker's first request."""
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+
+# Runs on import, so WSGI workers (or the gunicorn --preload master) start warm
+warm_templates()
+
+
 @app.cli.command("init-db")
 def init_db():
-    db.create_all()
+    create_schema()
     ensure_default_geofence()
     print("Database created. Default Geofence Ready.")
 
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        create_schema()
         ensure_default_geofence()
 
     app.run(host="0.0.0.0", port=5000, debug=True)